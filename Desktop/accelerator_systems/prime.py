@@ -9,6 +9,8 @@ import tensorflow.compat.v2 as tf
 import tensorflow_probability as tfp
 import numpy as np
 import os
+import functools
+import itertools
 import pickle
 import csv
 from typing import Optional, Dict, List
@@ -31,25 +33,57 @@ def get_angles(pos, i, d_model):
     return pos * angle_rates
 
 
+@functools.lru_cache(maxsize=None)
 def positional_encoding(position, d_model):
-    """Obtain positional encdoing for training the PRIME Transformer."""
+    """Obtain positional encdoing for training the PRIME Transformer.
+
+    The encoding only depends on its arguments, so it is computed once and
+    the same constant is shared by every layer that asks for it.
+    """
+    # indices 2i and 2i+1 share the same angle, so compute it once per pair
     angle_rads = get_angles(np.arange(position)[:, np.newaxis],
-                            np.arange(d_model)[np.newaxis, :],
+                            np.arange(0, d_model, 2)[np.newaxis, :],
                             d_model)
 
-    # apply sin to even indices in the array; 2i
-    angle_rads[:, 0::2] = np.sin(angle_rads[:, 0::2])
+    # apply sin to even indices (2i) and cos to odd indices (2i+1), by
+    # interleaving the two arrays in one pass.
+    pos_encoding = np.stack([np.sin(angle_rads), np.cos(angle_rads)], axis=-1)
+    pos_encoding = pos_encoding.reshape(position, -1)[:, :d_model]
+
+    pos_encoding = pos_encoding[np.newaxis, ...]
+
+    # Create the constant eagerly, so that a cached value never refers to a
+    # graph that was being traced on the first call.
+    with tf.init_scope():
+        return tf.constant(pos_encoding, dtype=tf.float32)
 
-    # apply cos to odd indices in the array; 2i+1
-    angle_rads[:, 1::2] = np.cos(angle_rads[:, 1::2])
 
-    pos_encoding = angle_rads[np.newaxis, ...]
+def split_glorot_uniform(fan_ins, fan_out):
+    """Glorot uniform initializer for kernels stacked along a leading axis.
+
+    Slice i is initialized like a Dense kernel with fan-in fan_ins[i]. Rows
+    past fan_ins[i] are padding, and are set to zero.
+    """
+
+    def initializer(shape, dtype=None):
+        dtype = dtype or tf.float32
+        kernels = []
+        for fan_in in fan_ins:
+            limit = np.sqrt(6.0 / (fan_in + fan_out))
+            kernel = tf.random.uniform(
+                (fan_in, fan_out), -limit, limit, dtype=dtype)
+            kernels.append(tf.pad(kernel, [[0, shape[1] - fan_in], [0, 0]]))
+        return tf.stack(kernels, axis=0)
 
-    return tf.cast(pos_encoding, dtype=tf.float32)
+    return initializer
 
 
 class SplitEmbeddingLayer(tf.keras.layers.Layer):
-    """Layer for embedding individual components in a split way"""
+    """Layer for embedding individual components in a split way
+
+    The input is the concatenation of the one-hot (or relaxed one-hot) vectors
+    of all the fields.
+    """
 
     def __init__(self, softmax_splits=None, output_size=32):
         """
@@ -59,94 +93,175 @@ class SplitEmbeddingLayer(tf.keras.layers.Layer):
         super(SplitEmbeddingLayer, self).__init__(trainable=True)
         self.softmax_splits = softmax_splits
         self.output_size = output_size
-
-        # create layers
-        self.dense_layers = []
-        # print(self.softmax_splits)
-        for idx, val in enumerate(self.softmax_splits):
-            self.dense_layers.append(
-                tf.keras.layers.Dense(
-                    self.output_size, name='insidelayer_' + str(idx)))
+        self.num_fields = len(self.softmax_splits)
+        self.max_split = max(self.softmax_splits)
+
+        # Each field is embedded with its own kernel. The kernels are padded
+        # to the widest field and stacked, so that all the fields can be
+        # embedded by a single batched einsum. The gather index below lays
+        # the input out as [num_fields, max_split]; padding entries point at
+        # column 0 and are zeroed out by the mask.
+        offsets = np.cumsum([0] + list(self.softmax_splits[:-1]))
+        columns = np.arange(self.max_split)
+        mask = columns[np.newaxis, :] < np.array(
+            self.softmax_splits)[:, np.newaxis]
+        gather_index = np.where(mask, offsets[:, np.newaxis] + columns, 0)
+        self.gather_index = tf.constant(gather_index.reshape(-1), tf.int32)
+        self.split_mask = tf.constant(mask, tf.float32)
 
         # Add position embeddings
         self.pos_encoding = positional_encoding(position=200, d_model=output_size)
 
+    def build(self, input_shape):
+        """Create the stacked per-field kernels and biases."""
+        self.kernel = self.add_weight(
+            name='kernel',
+            shape=(self.num_fields, self.max_split, self.output_size),
+            initializer=split_glorot_uniform(self.softmax_splits,
+                                             self.output_size))
+        self.bias = self.add_weight(
+            name='bias', shape=(self.num_fields, self.output_size),
+            initializer='zeros')
+        # Cast the constants once, rather than on every call.
+        self.split_mask = tf.cast(self.split_mask, self.compute_dtype)
+        self.pos_encoding = tf.cast(self.pos_encoding, self.compute_dtype)
+        super(SplitEmbeddingLayer, self).build(input_shape)
+
     def call(self, x):
-        """Call the Split embedding function."""
-        split_x = tf.split(x, num_or_size_splits=self.softmax_splits, axis=-1)
-        modified_splits = []
-        idx = 0
-        for param in split_x:
-            out = self.dense_layers[int(idx)](param)
-            modified_splits.append(tf.expand_dims(out, axis=1))
-            idx += 1
-        out = tf.concat(modified_splits, axis=1)
-        # print ('Out shape before: ', out)
-        out = out + self.pos_encoding[:, :len(modified_splits), :]
-        # print ('Out shape after: ', out)
+        """Call the Split embedding function.
+
+        The input is the concatenation of (relaxed) one-hot vectors, one per
+        field, and not the value indices of the fields: infer_negatives takes
+        gradients with respect to the one-hots, so the embedding stays a
+        product with the kernel rather than a lookup by index.
+        """
+        x = tf.gather(x, self.gather_index, axis=-1)
+        x = tf.reshape(x, (-1, self.num_fields, self.max_split))
+        x = x * self.split_mask
+        out = tf.einsum('bfs,fso->bfo', x, self.kernel) + self.bias
+        out = out + self.pos_encoding[:, :self.num_fields, :]
         return out
 
 
+class StackedDense(tf.keras.layers.Layer):
+    """A stack of independent Dense layers, applied together with an einsum.
+
+    Maps inputs of shape [B, in] (shared by all the layers in the stack) or
+    [B, num_stacked, in] to outputs of shape [B, num_stacked, units].
+    """
+
+    def __init__(self, num_stacked, units, **kwargs):
+        """Initialize num_stacked Dense layers with the given units each."""
+        super(StackedDense, self).__init__(**kwargs)
+        self.num_stacked = num_stacked
+        self.units = units
+
+    def build(self, input_shape):
+        """Create the stacked kernels, initialized like separate Dense ones."""
+        fan_in = int(input_shape[-1])
+        self.kernel = self.add_weight(
+            name='kernel', shape=(self.num_stacked, fan_in, self.units),
+            initializer=split_glorot_uniform([fan_in] * self.num_stacked,
+                                             self.units))
+        self.bias = self.add_weight(
+            name='bias', shape=(self.num_stacked, self.units),
+            initializer='zeros')
+        super(StackedDense, self).build(input_shape)
+
+    def call(self, x):
+        if x.shape.rank == 2:
+            out = tf.einsum('bi,vio->bvo', x, self.kernel)
+        else:
+            out = tf.einsum('bvi,vio->bvo', x, self.kernel)
+        return out + self.bias
+
+
 def scaled_dot_product_attention(q, k, v, mask):
-    """Scaled dot product attention in transformer."""
-    matmul_qk = tf.matmul(q, k, transpose_b=True)  # (..., seq_len_q, seq_len_k)
+    """Scaled dot product attention in transformer.
 
-    # scale matmul_qk
-    dk = tf.cast(tf.shape(k)[-1], tf.float32)
-    scaled_attention_logits = matmul_qk / tf.math.sqrt(dk)
+    q, k and v are laid out as (batch_size, seq_len, num_heads, depth), and
+    the output has the same layout. Both matmuls are einsums over this layout,
+    so the heads are never transposed.
+
+    The computation is kept in the matmul, scale, mask, softmax, matmul form
+    that XLA rewrites into a fused attention kernel on GPUs with cuDNN. The
+    rewrite needs a constant scale, and the attention weights must not be
+    used by anything else; callers should only ask for them when needed.
+    """
+    # (batch_size, num_heads, seq_len_q, seq_len_k)
+    matmul_qk = tf.einsum('bnhd,bmhd->bhnm', q, k)
+
+    # scale matmul_qk, by a constant when the depth is known statically
+    dk = k.shape[-1]
+    if dk is None:
+        dk = tf.cast(tf.shape(k)[-1], tf.float32)
+    scaled_attention_logits = matmul_qk / tf.math.sqrt(
+        tf.cast(dk, matmul_qk.dtype))
 
     # add the mask to the scaled tensor.
     if mask is not None:
         scaled_attention_logits += (mask * -1e9)
 
     # softmax is normalized on the last axis (seq_len_k) so that the scores
-    # add up to 1.
+    # add up to 1. It is always computed in float32.
     attention_weights = tf.nn.softmax(
-        scaled_attention_logits, axis=-1)  # (..., seq_len_q, seq_len_k)
-    output = tf.matmul(attention_weights, v)  # (..., seq_len_q, depth_v)
+        tf.cast(scaled_attention_logits, tf.float32),
+        axis=-1)  # (..., seq_len_q, seq_len_k)
+    output = tf.einsum(
+        'bhnm,bmhd->bnhd', tf.cast(attention_weights, v.dtype),
+        v)  # (batch_size, seq_len_q, num_heads, depth_v)
     return output, attention_weights
 
 
-def point_wise_feed_forward_network(d_model, dff):
-    return tf.keras.Sequential([
-        tf.keras.layers.Dense(dff, activation='relu'),
-        tf.keras.layers.Dense(d_model)  # (batch_size, seq_len, d_model)
-    ])
-
-
 class MultiHeadAttention(tf.keras.layers.Layer):
     """Multi Head Attention for the model."""
 
-    def __init__(self, d_model, num_heads):
-        """Initialize the multi-head attention model."""
+    def __init__(self, d_model, num_heads, self_attention=False):
+        """Initialize the multi-head attention model.
+
+        When self_attention is True, the queries, keys and values are always
+        computed from the same input, and are projected by a single fused
+        Dense layer instead of three separate ones.
+        """
         super(MultiHeadAttention, self).__init__()
         self.num_heads = num_heads
         self.d_model = d_model
+        self.self_attention = self_attention
 
         assert d_model % self.num_heads == 0
 
         self.depth = d_model // self.num_heads
 
-        self.wq = tf.keras.layers.Dense(d_model)
-        self.wk = tf.keras.layers.Dense(d_model)
-        self.wv = tf.keras.layers.Dense(d_model)
+        if self.self_attention:
+            self.wqkv = tf.keras.layers.Dense(3 * d_model)
+        else:
+            self.wq = tf.keras.layers.Dense(d_model)
+            self.wk = tf.keras.layers.Dense(d_model)
+            self.wv = tf.keras.layers.Dense(d_model)
 
         self.dense = tf.keras.layers.Dense(d_model)
 
     def split_heads(self, x, batch_size):
         """Split the last dimension into (num_heads, depth).
-    Transpose the result such that the
-    shape is (batch_size, num_heads, seq_len, depth)
+    The shape of the result is (batch_size, seq_len, num_heads, depth)
     """
-        x = tf.reshape(x, (batch_size, -1, self.num_heads, self.depth))
-        return tf.transpose(x, perm=[0, 2, 1, 3])
+        return tf.reshape(x, (batch_size, -1, self.num_heads, self.depth))
+
+    def call(self, v, k, q, mask, return_attention_scores=False):
+        """Attend over v with keys k and queries q.
 
-    def call(self, v, k, q, mask):
+        Returns the attention output, and the attention weights only if
+        return_attention_scores is True.
+        """
         batch_size = tf.shape(q)[0]
 
-        q = self.wq(q)
-        k = self.wk(k)
-        v = self.wv(v)
+        if self.self_attention:
+            # v, k and q are the same tensor in this case.
+            q, k, v = tf.split(self.wqkv(q), 3, axis=-1)
+        else:
+            q = self.wq(q)
+            k = self.wk(k)
+            v = self.wv(v)
 
         q = self.split_heads(q, batch_size)
         k = self.split_heads(k, batch_size)
@@ -155,14 +270,14 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         scaled_attention, attention_weights = scaled_dot_product_attention(
             q, k, v, mask)
 
-        scaled_attention = tf.transpose(scaled_attention, perm=[0, 2, 1, 3])
-
         concat_attention = tf.reshape(scaled_attention,
                                       (batch_size, -1, self.d_model))
 
         output = self.dense(concat_attention)
 
-        return output, attention_weights
+        if return_attention_scores:
+            return output, attention_weights
+        return output
 
 
 class TransformerLayer(tf.keras.layers.Layer):
@@ -172,8 +287,10 @@ class TransformerLayer(tf.keras.layers.Layer):
         """Initialize the transformer layer."""
         super(TransformerLayer, self).__init__()
 
-        self.mha = MultiHeadAttention(d_model, num_heads)
-        self.ffn = point_wise_feed_forward_network(d_model, dff)
+        self.d_model = d_model
+        self.dff = dff
+
+        self.mha = MultiHeadAttention(d_model, num_heads, self_attention=True)
 
         self.layernorm1 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
         self.layernorm2 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
@@ -181,25 +298,90 @@ class TransformerLayer(tf.keras.layers.Layer):
         self.dropout1 = tf.keras.layers.Dropout(rate)
         self.dropout2 = tf.keras.layers.Dropout(rate)
 
+    def build(self, input_shape):
+        """Create the weights of the point wise feed forward network."""
+        self.ffn_kernel1 = self.add_weight(
+            name='ffn_kernel1', shape=(self.d_model, self.dff),
+            initializer='glorot_uniform')
+        self.ffn_bias1 = self.add_weight(
+            name='ffn_bias1', shape=(self.dff,), initializer='zeros')
+        self.ffn_kernel2 = self.add_weight(
+            name='ffn_kernel2', shape=(self.dff, self.d_model),
+            initializer='glorot_uniform')
+        self.ffn_bias2 = self.add_weight(
+            name='ffn_bias2', shape=(self.d_model,), initializer='zeros')
+        super(TransformerLayer, self).build(input_shape)
+
     def call(self, x, training=True, mask=None):
-        attn_output, _ = self.mha(x, x, x, mask)
+        attn_output = self.mha(x, x, x, mask)
         # (batch_size, input_seq_len, d_model)
         attn_output = self.dropout1(attn_output, training=training)
         out1 = self.layernorm1(x + attn_output)
         # (batch_size, input_seq_len, d_model)
 
-        ffn_output = self.ffn(out1)  # (batch_size, input_seq_len, d_model)
+        # Point wise feed forward network, as two matmuls with the bias adds
+        # and the relu inlined.
+        ffn_output = tf.nn.relu(
+            tf.matmul(out1, self.ffn_kernel1) + self.ffn_bias1)
+        ffn_output = tf.matmul(
+            ffn_output, self.ffn_kernel2) + self.ffn_bias2
+        # (batch_size, input_seq_len, d_model)
         ffn_output = self.dropout2(ffn_output, training=training)
         out2 = self.layernorm2(out1 + ffn_output)
         # (batch_size, input_seq_len, d_model)
         return out2
 
+
+class TransformerStack(tf.keras.layers.Layer):
+    """A stack of TransformerLayers, with optional activation checkpointing."""
+
+    def __init__(self, num_layers, d_model, num_heads, dff, rate=0.1,
+                 recompute_grad=False):
+        """Initialize the stack of transformer layers.
+
+        With recompute_grad, the stack is split into segments of about
+        sqrt(num_layers) layers. Only the input of each segment is kept for
+        the backward pass, and the activations inside it are recomputed.
+        Dropout masks are not replayed when recomputing, which would take the
+        gradient through different masks than the forward pass, so
+        recompute_grad requires rate=0.
+        """
+        if recompute_grad and rate > 0:
+            raise ValueError(
+                'recompute_grad does not replay dropout masks, it requires '
+                'rate=0 but got rate={}'.format(rate))
+        super(TransformerStack, self).__init__()
+        self.recompute_grad = recompute_grad
+        self.enc_layers = [TransformerLayer(d_model, num_heads, dff, rate)
+                           for _ in range(num_layers)]
+        self.segment_size = int(np.ceil(np.sqrt(num_layers)))
+
+    def call(self, x, training=True):
+        for start in range(0, len(self.enc_layers), self.segment_size):
+            segment = self.enc_layers[start:start + self.segment_size]
+
+            def forward(x, segment=segment):
+                for layer in segment:
+                    x = layer(x, training=training)
+                return x
+
+            if self.recompute_grad and training:
+                x = tf.recompute_grad(forward)(x)
+            else:
+                x = forward(x)
+        return x
+
 #@title Helper functions for MSE/Huber Loss computation
 
+def _flat(tensor):
+  """Reshape a tensor to rank 1, e.g. [B] or [B, 1] predictions to [B]."""
+  return tf.reshape(tensor, [-1])
+
+
 def weighted_mse_loss(input, target, weight):
   """Compute weighted MSE Loss"""
-  mse_loss_val = (tf.squeeze(input) - tf.squeeze(target))**2
-  return tf.reduce_mean(mse_loss_val * tf.squeeze(weight))
+  diff = _flat(tf.cast(input, tf.float32)) - _flat(target)
+  return tf.reduce_mean(diff * diff * _flat(weight))
 
 
 def weighted_huber_loss(input, target, weight):
@@ -207,131 +389,137 @@ def weighted_huber_loss(input, target, weight):
   mse_loss = tf.keras.losses.Huber(
       reduction=tf.keras.losses.Reduction.NONE)
   return tf.reduce_mean(mse_loss(
-      y_pred=tf.squeeze(input),
-      y_true=tf.squeeze(target)) * tf.squeeze(weight))
+      y_pred=_flat(tf.cast(input, tf.float32)),
+      y_true=_flat(target)) * _flat(weight))
 
 
 def weighted_approx_loss(input, target, weight):
   """Compute weighted Approximation Loss"""
-  abs_diff = tf.abs(tf.squeeze(input) - tf.squeeze(target))
-  ratio_diff = abs_diff / (tf.abs(tf.squeeze(target)) + 1e-6)
-  return tf.reduce_mean(ratio_diff * tf.squeeze(weight))
+  target = _flat(target)
+  abs_diff = tf.abs(_flat(tf.cast(input, tf.float32)) - target)
+  ratio_diff = abs_diff / (tf.abs(target) + 1e-6)
+  return tf.reduce_mean(ratio_diff * _flat(weight))
 
 #@title Helper functions for ranking loss computation
 
-def ranking_loss(input, target, context=None):
-  """Compute measures of ranking for the PRIMETransformerModel."""
-  if context is not None:
-    # Compute ranking loss per context, and then average it.
-    unique_contexts, indices = tf.unique(
-        tf.squeeze(tf.cast(context, tf.int32)), name='None')
-    all_corr = []
-    for idx in range(unique_contexts.shape[0]):
-      curr_context = unique_contexts[idx]
-      locations_idx = tf.squeeze(tf.where(tf.equal(indices, curr_context)))
-      input_tmp = tf.gather(
-          tf.squeeze(input), indices=locations_idx)
-      target_tmp = tf.gather(
-          tf.squeeze(target), indices=locations_idx)
-      input_ranks = tf.argsort(input_tmp, axis=-1)
-      target_ranks = tf.argsort(target_tmp, axis=-1)
-      input_ranks = tf.cast(tf.argsort(input_ranks, axis=-1), dtype=tf.float32)
-      target_ranks = tf.cast(tf.argsort(target_ranks, axis=-1),
-                             dtype=tf.float32)
-      std_input = tf.math.reduce_std(input_ranks)
-      std_target = tf.math.reduce_std(target_ranks)
-      cov = tf.reduce_mean((target_ranks - tf.reduce_mean(target_ranks)) *\
-                           (input_ranks - tf.reduce_mean(input_ranks)))
-      pearson_corr = cov/ (std_target * std_input)
-      all_corr.append(pearson_corr)
-    print (all_corr)
-    pearson_corr = tf.reduce_mean(pearson_corr)
+def group_by_context(context, batch_size):
+  """Group the elements of a batch by their context.
+
+  Returns a [B, B] float mask that is 1 where two elements share a context,
+  and a segment id per element in [0, B): the position of the first element
+  with the same context. The segment ids are derived from the mask rather
+  than tf.unique, so that the number of segments is known statically. Without
+  a context, the whole batch is a single group.
+  """
+  if context is None:
+    same_context = tf.ones((batch_size, batch_size))
   else:
-    input = tf.squeeze(input)
-    target = tf.squeeze(target)
-    input_ranks = tf.argsort(input, axis=-1)
-    target_ranks = tf.argsort(target, axis=-1)
-    input_ranks = tf.cast(tf.argsort(input_ranks, axis=-1), dtype=tf.float32)
-    target_ranks = tf.cast(tf.argsort(target_ranks, axis=-1), dtype=tf.float32)
-    std_input = tf.math.reduce_std(input_ranks)
-    std_target = tf.math.reduce_std(target_ranks)
-    cov = tf.reduce_mean((target_ranks - tf.reduce_mean(target_ranks)) *\
-                         (input_ranks - tf.reduce_mean(input_ranks)))
-    pearson_corr = cov/ (std_target * std_input)
-  return pearson_corr
+    context = tf.reshape(tf.cast(context, tf.int32), [-1])
+    same_context = tf.cast(
+        tf.equal(context[:, None], context[None, :]), dtype=tf.float32)
+  segment_ids = tf.argmax(same_context, axis=-1, output_type=tf.int32)
+  return same_context, segment_ids
+
+
+def segment_ranks(x, segment_ids, num_segments):
+  """Rank the values of x within each segment, starting from 0."""
+  # Sort by value, then stably by segment, so each segment is contiguous and
+  # sorted by value.
+  order = tf.argsort(x, axis=-1, stable=True)
+  order = tf.gather(order, tf.argsort(
+      tf.gather(segment_ids, order), axis=-1, stable=True))
+  # Invert the permutation with a scatter, rather than sorting it again.
+  positions = tf.scatter_nd(tf.expand_dims(order, -1),
+                            tf.range(tf.size(order)), tf.shape(order))
+  counts = tf.math.unsorted_segment_sum(
+      tf.ones_like(segment_ids), segment_ids, num_segments)
+  starts = tf.cumsum(counts, exclusive=True)
+  return tf.cast(positions - tf.gather(starts, segment_ids), dtype=tf.float32)
+
+
+def scaled_ranks(ranks, group_size):
+  """Standardize ranks, given the size of the group each rank belongs to.
+
+  The ranks of a group of n elements are a permutation of 0, ..., n-1, so
+  their mean (n-1)/2 and variance (n^2-1)/12 are known without reducing over
+  the ranks.
+  """
+  return (ranks - (group_size - 1.0) / 2.0) * \
+         tf.math.rsqrt((group_size * group_size - 1.0) / 12.0)
+
+
+def ranking_loss(input, target, context=None):
+  """Compute measures of ranking for the PRIMETransformerModel.
+
+  With a context, the rank correlation is computed per context, and then
+  averaged over the contexts.
+  """
+  input = tf.reshape(input, [-1])
+  target = tf.reshape(target, [-1])
+  batch_size = tf.shape(input)[0]
+  _, segment_ids = group_by_context(context, batch_size)
+
+  counts = tf.math.unsorted_segment_sum(
+      tf.ones_like(input), segment_ids, batch_size)
+  group_size = tf.gather(counts, segment_ids)
+  input_ranks = scaled_ranks(
+      segment_ranks(input, segment_ids, batch_size), group_size)
+  target_ranks = scaled_ranks(
+      segment_ranks(target, segment_ids, batch_size), group_size)
+  pearson_corr = tf.math.unsorted_segment_sum(
+      input_ranks * target_ranks, segment_ids, batch_size) / \
+                 tf.maximum(counts, 1.0)
+
+  # Unused segment ids have no elements, and are left out of the average.
+  present = counts > 0
+  return tf.reduce_sum(tf.where(present, pearson_corr, 0.0)) / \
+         tf.reduce_sum(tf.cast(present, dtype=tf.float32))
 
 
 def ranking_trainable_loss(input, target, context=None):
   """Compute a differentiable ranking loss, that can be used for training."""
-  if context is not None:
-    unique_contexts, indices = tf.unique(
-        tf.squeeze(tf.cast(context, tf.int32)), name='None')
-    all_corr = []
-    for idx in range(unique_contexts.shape[0]):
-      curr_context = unique_contexts[idx]
-      locations_idx = tf.squeeze(tf.where(tf.equal(indices, curr_context)))
-      input_tmp = tf.expand_dims(tf.gather(
-          tf.squeeze(input), indices=locations_idx), 1)
-      target_tmp = tf.expand_dims(tf.gather(
-          tf.squeeze(target), indices=locations_idx), 1)
-      input_transpose = tf.transpose(input_tmp, [1, 0]) # 1 x B
-      target_transpose = tf.transpose(target_tmp, [1, 0]) # 1 x B
-      diff_true = input_tmp - input_transpose # B x 1 - 1 x B = B x B = y_i - y_j
-      diff_pred = target_tmp - target_transpose # fx_i - fx_j
-      product = tf.sign(diff_true) * diff_pred  # sign(y_i = y_j) * (fx_i - fxj)
-      bce_loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(
-          labels=tf.ones_like(product), logits=product))
-      all_corr.append(bce_loss)
-    bce_loss = tf.reduce_mean(all_corr)
-  else:
-    input_transpose = tf.transpose(input, [1, 0]) # 1 x B
-    target_transpose = tf.transpose(target, [1, 0]) # 1 x B
-    diff_true = input - input_transpose # B x 1 - 1 x B = B x B = y_i - y_j
-    diff_pred = target - target_transpose # fx_i - fx_j
-    product = tf.sign(diff_true) * diff_pred  # sign(y_i = y_j) * (fx_i - fxj)
-    bce_loss = tf.nn.sigmoid_cross_entropy_with_logits(
-        labels=tf.ones_like(product), logits=product)
-  return tf.reduce_mean(bce_loss)
+  input = tf.reshape(input, [-1, 1]) # B x 1
+  target = tf.reshape(target, [-1, 1]) # B x 1
+  input_transpose = tf.transpose(input, [1, 0]) # 1 x B
+  target_transpose = tf.transpose(target, [1, 0]) # 1 x B
+  diff_true = input - input_transpose # B x 1 - 1 x B = B x B = y_i - y_j
+  diff_pred = target - target_transpose # fx_i - fx_j
+  product = tf.sign(diff_true) * diff_pred  # sign(y_i = y_j) * (fx_i - fxj)
+  bce_loss = tf.nn.sigmoid_cross_entropy_with_logits(
+      labels=tf.ones_like(product), logits=product)
+
+  # Average over the pairs within each context, and then over the contexts.
+  same_context, _ = group_by_context(context, tf.shape(input)[0])
+  group_size = tf.reduce_sum(same_context, axis=-1)
+  num_groups = tf.reduce_sum(1.0 / group_size)
+  bce_loss = tf.reduce_sum(bce_loss * same_context, axis=-1) / group_size**2
+  return tf.reduce_sum(bce_loss) / num_groups
 
 
 #@title Helper function for Kendall correlation
 
 def kendall_correlation(input, target, context=None):
   """Compute Kendall's correlation over the input, target and context."""
-  if context is not None:
-    unique_contexts, indices = tf.unique(
-        tf.squeeze(tf.cast(context, tf.int32)), name='None')
-    all_corr = []
-    for idx in range(unique_contexts.shape[0]):
-      curr_context = unique_contexts[idx]
-      locations_idx = tf.squeeze(tf.where(tf.equal(indices, curr_context)))
-      input_tmp = tf.expand_dims(tf.gather(
-          tf.squeeze(input), indices=locations_idx), 1)
-      target_tmp = tf.expand_dims(tf.gather(
-          tf.squeeze(target), indices=locations_idx), 1)
-      input_transpose = tf.transpose(input_tmp, [1, 0])
-      target_transpose = tf.transpose(target_tmp, [1, 0])
-      diff_true = input_tmp - input_transpose
-      diff_pred = target_tmp - target_transpose
-      product = tf.sign(diff_true) * tf.sign(diff_pred)
-      positive_pairs = tf.where(tf.greater_equal(product, tf.zeros_like(product)),
-                                tf.ones_like(product), tf.zeros_like(product))
-      n = tf.cast(tf.shape(input_tmp)[0], dtype=tf.float32)
-      total_positive = tf.reduce_sum(positive_pairs) - n
-      ratio = total_positive/ (n * (n-1))
-      all_corr.append(ratio)
-    ratio = tf.reduce_mean(all_corr)
-  else:
-    input_transpose = tf.transpose(input, [1, 0])
-    target_transpose = tf.transpose(target, [1, 0])
-    diff_true = input - input_transpose
-    diff_pred = target - target_transpose
-    product = tf.sign(diff_true) * tf.sign(diff_pred)
-    positive_pairs = tf.where(tf.greater_equal(product, tf.zeros_like(product)),
-                              tf.ones_like(product), tf.zeros_like(product))
-    n = tf.cast(tf.shape(input)[0], dtype=tf.float32)
-    total_positive = tf.reduce_sum(positive_pairs) - n
-    ratio = total_positive/ (n * (n-1))
+  input = tf.reshape(input, [-1, 1])
+  target = tf.reshape(target, [-1, 1])
+  input_transpose = tf.transpose(input, [1, 0])
+  target_transpose = tf.transpose(target, [1, 0])
+  diff_true = input - input_transpose
+  diff_pred = target - target_transpose
+  product = tf.sign(diff_true) * tf.sign(diff_pred)
+  positive_pairs = tf.cast(product >= 0, tf.float32)
+
+  # Count the positive pairs within each context and average the ratio over
+  # the contexts. The pair matrix is symmetric, so only the strict upper
+  # triangle is counted and the count is doubled.
+  n = tf.shape(input)[0]
+  same_context, _ = group_by_context(context, n)
+  pair_mask = tf.linalg.band_part(same_context, 0, -1) - tf.eye(n)
+  group_size = tf.reduce_sum(same_context, axis=-1)
+  num_groups = tf.reduce_sum(1.0 / group_size)
+  total_positive = tf.reduce_sum(positive_pairs * pair_mask, axis=-1)
+  ratio = 2.0 * tf.reduce_sum(
+      total_positive / (group_size * (group_size - 1))) / num_groups
   return 2 * ratio - 1.0
 
 
@@ -438,12 +626,24 @@ class PRIMETransformerModel(tf.keras.Model):
     if 'use_dropout' in params_dict:
       use_dropout = params_dict['use_dropout']
 
+    # Whether to recompute the activations of the transformer layers in the
+    # backward pass instead of storing them, trading compute for memory. The
+    # transformer layers are then built without dropout, as the dropout masks
+    # would not be replayed in the recomputation.
+    recompute_grad = False
+    if 'recompute_grad' in params_dict:
+      recompute_grad = params_dict['recompute_grad']
+
     if self.contextual:
       """For contextual version of PRIME"""
       self.num_contexts = 0
       if 'num_contexts' in params_dict:
         self.num_contexts = params_dict['num_contexts']
 
+      # Width of the design part of an input that is passed as a single
+      # tensor, with the context concatenated after the design.
+      self._design_dim = num_inputs
+
     print('Infeasible alpha: ', self.infeasible_alpha)
     print('CQL Alpha: ', self.log_cql_alpha)
     print('Num votes: ', self.num_votes)
@@ -459,8 +659,9 @@ class PRIMETransformerModel(tf.keras.Model):
       x = tf.keras.layers.Dropout(rate=0.1)(x)
 
     # Now feed the split embedding layer output into TransformerLayer
-    x = TransformerLayer(d_model=64, num_heads=8, dff=256)(x)
-    x = TransformerLayer(d_model=64, num_heads=8, dff=256)(x)
+    x = TransformerStack(num_layers=2, d_model=64, num_heads=8, dff=256,
+                         rate=0.0 if recompute_grad else 0.1,
+                         recompute_grad=recompute_grad)(x)
 
     x = tf.keras.layers.Reshape(target_shape=(640,))(x)
 
@@ -484,23 +685,21 @@ class PRIMETransformerModel(tf.keras.Model):
     layers[0] = 64 * len(self.input_splits)
 
     """Voting based routing"""
-    num_networks = self.num_votes
-    self._all_networks = []
-    for jdx in range(num_networks):
-      # Make each of the networks used in routing
-      new_network = tf.keras.Sequential()
-      for idx in range(len(layers) - 1):
-        new_network.add(
-          tf.keras.layers.Dense(layers[idx + 1], input_shape=(layers[idx],)))
-        new_network.add(tf.keras.layers.LeakyReLU(0.1))
-        if use_dropout:
-          new_network.add(tf.keras.layers.Dropout(rate=0.1))
-
-      new_network.add(tf.keras.layers.Dense(
-        num_outputs, input_shape=(layers[idx],)))
-      self._all_networks.append(new_network)
-
-    self.optimize_networks.extend(self._all_networks)
+    # The networks used in routing are evaluated together: each layer holds
+    # the weights of all the networks stacked along a num_votes axis.
+    self._fused_expert_mlp = tf.keras.Sequential()
+    for idx in range(len(layers) - 1):
+      self._fused_expert_mlp.add(StackedDense(
+        self.num_votes, layers[idx + 1], input_shape=(layers[idx],)))
+      self._fused_expert_mlp.add(tf.keras.layers.LeakyReLU(0.1))
+      if use_dropout:
+        self._fused_expert_mlp.add(tf.keras.layers.Dropout(rate=0.1))
+
+    self._fused_expert_mlp.add(StackedDense(
+      self.num_votes, num_outputs, input_shape=(layers[idx],),
+      dtype='float32'))
+
+    self.optimize_networks.append(self._fused_expert_mlp)
 
     # Now make the network that decides the contribution of these
     self.voting_network = tf.keras.Sequential()
@@ -515,7 +714,8 @@ class PRIMETransformerModel(tf.keras.Model):
       self.voting_network.add(tf.keras.layers.Dropout(rate=0.1))
 
     self.voting_network.add(
-      tf.keras.layers.Dense(self.num_votes, input_shape=(layers[1],)))
+      tf.keras.layers.Dense(self.num_votes, input_shape=(layers[1],),
+                            dtype='float32'))
 
     if self.contextual:
       # Add the vote generation network input again
@@ -531,24 +731,46 @@ class PRIMETransformerModel(tf.keras.Model):
 
     print('All networks: ', len(self.optimize_networks))
 
-  @tf.function
+    # Flat list of the trainable variables of optimize_networks, built on the
+    # first training step and reused after, so that the train step sees the
+    # same list on every call.
+    self._optimized_variables = None
+
+    # Graph-compiled training steps, by loss type and ranking penalty weight
+    self._train_step_fns = {}
+
   def call(self, inputs, training=True, with_logging=False):
-    """Function to call one forward pass on the PRIME Transformer."""
-    extra_dict = dict()
-    if not self.contextual:
-      transformer_embedding = self._base_network(inputs, training=training)
-    else:
-      # TODO(aviralkumar): Fix the hardcoded 77 input dimensionality in code
-      if not isinstance(inputs, list) and not isinstance(inputs, tuple):
-        inputs = (inputs[:, :77], inputs[:, 77:])
+    """Function to call one forward pass on the PRIME Transformer.
 
-      transformer_embedding = self._base_network(inputs, training=training)
+    With with_logging, also returns a dictionary of per-example values for
+    logging, which the caller is expected to reduce.
+    """
+    # Contextual inputs are passed to the compiled forward pass as a
+    # (design, context) tuple, however they were given, so that the
+    # different ways of calling the model share the same traces.
+    if self.contextual:
+      if isinstance(inputs, (list, tuple)):
+        inputs = tuple(inputs)
+      else:
+        inputs = tuple(tf.split(
+          inputs, [self._design_dim, self.num_contexts], axis=1))
+    return self._forward(inputs, training=training, with_logging=with_logging)
+
+  @tf.function(jit_compile=True, reduce_retracing=True)
+  def _forward(self, inputs, training, with_logging):
+    """Compiled forward pass, see call.
+
+    All the experts are evaluated by the one stacked MLP, so the traced graph
+    has no per-expert ops and its size does not grow with num_votes. The
+    number of experts is part of the weight shapes and is fixed per model, a
+    different num_votes means a new model and so a new trace.
+    """
+    extra_dict = dict()
+    transformer_embedding = self._base_network(inputs, training=training)
 
-    # Get all outputs from each expert
-    all_outputs = []
-    for idx in range(self.num_votes):
-      all_outputs.append(
-        self._all_networks[idx](transformer_embedding, training=training))
+    # Get all outputs from each expert, [B x num_votes x num_outputs]
+    all_outputs = self._fused_expert_mlp(transformer_embedding,
+                                         training=training)
 
     # Get the voting probabilities
     if self.contextual:
@@ -559,14 +781,17 @@ class PRIMETransformerModel(tf.keras.Model):
       vote_logit = self.voting_network(transformer_embedding,
                                        training=training)
 
-    # Append all_outputs in a list and compute average score
-    all_outputs = tf.concat(all_outputs, axis=-1)  # [B x num_votes]
-    vote_prob = tf.nn.softmax(vote_logit, axis=-1)  # [B x num_votes]
+    # Compute the average score weighted by the votes. The probabilities and
+    # log probabilities share the shifted logits and the normalizer.
+    vote_logit = vote_logit - tf.reduce_max(vote_logit, axis=-1, keepdims=True)
+    vote_exp = tf.exp(vote_logit)
+    vote_norm = tf.reduce_sum(vote_exp, axis=-1, keepdims=True)
+    vote_prob = vote_exp / vote_norm  # [B x num_votes]
     vote_entropy = tf.reduce_sum(
-      tf.nn.log_softmax(vote_logit, axis=-1) * vote_prob, axis=-1)
-    extra_dict['vote_entropy'] = tf.reduce_mean(vote_entropy)
-    fwd_model_pred = tf.reduce_sum(vote_prob * all_outputs, axis=-1)
-    fwd_model_pred = tf.expand_dims(fwd_model_pred, axis=-1)
+      (vote_logit - tf.math.log(vote_norm)) * vote_prob, axis=-1)
+    extra_dict['vote_entropy'] = vote_entropy
+    fwd_model_pred = tf.reduce_sum(
+      vote_prob[..., tf.newaxis] * all_outputs, axis=1)
 
     if with_logging:
       return fwd_model_pred, extra_dict
@@ -574,7 +799,7 @@ class PRIMETransformerModel(tf.keras.Model):
     return fwd_model_pred
 
   def compute_loss(self, data_batch, loss_type='mse', training=True,
-                   ranking_penalty_weight=0.0, inp_batch_type=None):
+                   ranking_penalty_weight=0.0, include_invalid=True):
     """
     Compute the loss function and additional logging metrics for training.
 
@@ -590,9 +815,10 @@ class PRIMETransformerModel(tf.keras.Model):
         ranking regularization for training if needed. Though, we did not find
         this to be essential.
 
-      inp_batch_type: string, either 'valid' or 'mixed'. Mixed indicates that
-        the batch consists of both valid and invalid samples, whereas valid
-        indicates the samples are only valid samples.
+      include_invalid: bool, whether the batch also carries invalid samples
+        (under the invalid/ keys) to train the infeasibility penalty on. False
+        for a 'valid' batch which only consists of valid samples, True for a
+        'mixed' batch which consists of both.
 
       ranking_penalty_weight: float, the weight on the ranking loss function
         in addition to the PRIME objectives. This is not needed for PRIME, but
@@ -611,15 +837,11 @@ class PRIMETransformerModel(tf.keras.Model):
     data_batch = data_batch.copy()
     weights = tf.ones_like(data_batch['objective'])
 
+    # The forward passes on the designs in the batch, on the negatives and on
+    # the invalid designs are concatenated into a single batched call.
+    designs = [data_batch['design']]
     if self.contextual:
-      model_pred, extra_dict = self(
-        inputs=[data_batch['design'], data_batch['context_id']],
-        training=training, with_logging=True)
-    else:
-      model_pred, extra_dict = self(
-        data_batch['design'], training=training, with_logging=True)
-
-    loss_dict.update(extra_dict)
+      contexts = [data_batch['context_id']]
 
     if self.negative_sampler is not None:
       # This branch of the code will not run off-the-shelf, since it assumes
@@ -631,21 +853,40 @@ class PRIMETransformerModel(tf.keras.Model):
       negatives_pred = self(inputs=negatives_batch, training=training)
     else:
       negatives_batch = self.infer_negatives(data_batch)
+      designs.append(negatives_batch['design'])
       if self.contextual:
-        negatives_pred = self(
-          (negatives_batch['design'], negatives_batch['context_id']),
-          training=training)
-      else:
-        negatives_pred = self(negatives_batch['design'], training=True)
+        contexts.append(negatives_batch['context_id'])
+
+    if include_invalid:
+      designs.append(data_batch['invalid/design'])
+      if self.contextual:
+        contexts.append(data_batch['context_id'])
 
+    split_sizes = [tf.shape(design)[0] for design in designs]
+    inputs = tf.concat(designs, axis=0)
+    if self.contextual:
+      inputs = (inputs, tf.concat(contexts, axis=0))
+    all_pred, extra_dict = self(inputs, training=training, with_logging=True)
+    all_pred = tf.split(all_pred, split_sizes, axis=0)
+
+    model_pred = all_pred[0]
+    if self.negative_sampler is None:
+      negatives_pred = all_pred[1]
+    if include_invalid:
+      model_pred_invalid = all_pred[-1]
+
+    for key in extra_dict:
+      extra_values = tf.split(extra_dict[key], split_sizes, axis=0)
+      loss_dict[key] = tf.reduce_mean(extra_values[0])
+      if include_invalid:
+        loss_dict['invalid/' + key] = tf.reduce_mean(extra_values[-1])
+
+    # The per-example clip bounds the mean to [-4000, 4000] as well, so the
+    # cql loss needs no second clip and the same mean is reused for logging.
     negatives_pred = tf.clip_by_value(negatives_pred, clip_value_min=-4000.0,
                                       clip_value_max=4000.0)
-
     cql_loss = tf.reduce_mean(negatives_pred)
-    cql_loss = tf.clip_by_value(cql_loss,
-                                clip_value_min=-4000,
-                                clip_value_max=1e6)
-    loss_dict['negatives_dist'] = tf.reduce_mean(negatives_pred)
+    loss_dict['negatives_dist'] = cql_loss
 
     mse_loss = weighted_mse_loss(
       model_pred, data_batch['objective'], weights)
@@ -682,29 +923,18 @@ class PRIMETransformerModel(tf.keras.Model):
     loss_dict['avg_ranking_train_loss'] = avg_ranking_train_loss
     loss_dict['avg_kendall_loss'] = avg_kendall_loss
     loss_dict['cql_loss'] = cql_loss
-    loss_dict['negatives_pred'] = tf.reduce_mean(negatives_pred)
+    loss_dict['negatives_pred'] = cql_loss
     loss_dict['model_pred_average'] = tf.reduce_mean(model_pred)
     train_loss = train_loss + ranking_penalty_weight * avg_ranking_train_loss
     train_loss = train_loss + self.cql_alpha_value * cql_loss
 
-    if inp_batch_type is not 'valid':
+    if include_invalid:
       weights_negatives = tf.ones_like(data_batch['objective'])
-      if self.contextual:
-        model_pred_invalid, invalid_dict = self(
-          inputs=(data_batch['invalid/design'], data_batch['context_id']),
-          training=training, with_logging=True)
-      else:
-        model_pred_invalid, invalid_dict = self(
-          data_batch['invalid/design'], training=training, with_logging=True)
-
-      for key in invalid_dict:
-        loss_dict['invalid/' + key] = invalid_dict[key]
 
       ## Conservatism training
-      loss_dict['y_value_infeasible'] = tf.reduce_mean(model_pred_invalid)
       loss_dict['y_value_infeasible'] = tf.clip_by_value(
-        loss_dict['y_value_infeasible'],
-        clip_value_min=-1000, clip_value_max=1e6)
+        tf.reduce_mean(model_pred_invalid),
+        clip_value_min=-1000.0, clip_value_max=1e6)
       train_loss = train_loss + self.infeasible_alpha * \
                    loss_dict['y_value_infeasible']
 
@@ -726,28 +956,65 @@ class PRIMETransformerModel(tf.keras.Model):
     Actually perform training by computing loss, and then taking gradients
     through it. Makes sure to backpropagate through all networks.
     """
-    with tf.GradientTape(
-            watch_accessed_variables=False, persistent=True) as tape:
-      tape.watch(
-        [v for net in self.optimize_networks \
-         for v in net.trainable_variables])
+    # Only 'mixed' batches carry invalid samples to train the infeasibility
+    # penalty on. Like the batch structure, this is fixed per signature.
+    include_invalid = 'invalid/design' in batch
+    key = '{}_{}_{}'.format(loss_type, ranking_penalty_weight, include_invalid)
+    if key not in self._train_step_fns:
+      # The step is traced once, for the shapes and dtypes of the first batch.
+      # The training batches all share them, so a batch that does not is an
+      # error rather than a silent retrace.
+      self._train_step_fns[key] = tf.function(
+        functools.partial(self._train_step, loss_type=loss_type,
+                          ranking_penalty_weight=ranking_penalty_weight,
+                          include_invalid=include_invalid),
+        input_signature=[
+          tf.nest.map_structure(tf.TensorSpec.from_tensor, batch)])
+    return self._train_step_fns[key](batch)
+
+  def _train_step(self, batch, loss_type, ranking_penalty_weight,
+                  include_invalid):
+    """Training step: forward, backward and optimizer update.
+
+    Graph-compiled by perform_training. The forward passes inside are jit
+    compiled through call(). The step as a whole is not forced through XLA,
+    which was much slower than this on CPU; the remaining ops can be left to
+    XLA auto-clustering (see train_eval_offline).
+    """
+    if self._optimized_variables is None:
+      self._optimized_variables = list(itertools.chain.from_iterable(
+        net.trainable_variables for net in self.optimize_networks))
+
+    # All the networks are optimized on the same loss, so a single gradient
+    # call is needed and the tape does not have to be persistent.
+    loss_scaling = isinstance(
+      self.optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+    with tf.GradientTape(watch_accessed_variables=False) as tape:
+      tape.watch(self._optimized_variables)
       loss_dict, loss_train = self.compute_loss(
         batch, loss_type, training=True,
-        ranking_penalty_weight=ranking_penalty_weight)
-
-    grads = tape.gradient(loss_train,
-                          [v for net in self.optimize_networks \
-                           for v in net.trainable_variables])
+        ranking_penalty_weight=ranking_penalty_weight,
+        include_invalid=include_invalid)
+      if loss_scaling:
+        loss_train = self.optimizer.get_scaled_loss(loss_train)
+
+    grads = tape.gradient(loss_train, self._optimized_variables)
+    if loss_scaling:
+      grads = self.optimizer.get_unscaled_gradients(grads)
     gen_grads_op = self.optimizer.apply_gradients(
-      zip(grads, [v for net in self.optimize_networks \
-                  for v in net.trainable_variables]))
+      zip(grads, self._optimized_variables))
     return loss_dict
 
   def measure_stats(self, batch, batch_type=None, **kwargs):
     """Simply make a forward pass through compute_loss to measure losses."""
+    return self._eval_step(batch, include_invalid=batch_type != 'valid')
+
+  @tf.function
+  def _eval_step(self, batch, include_invalid):
+    """Graph-compiled evaluation step, see _train_step."""
     loss_dict, _ = self.compute_loss(batch, loss_type='mse+rank',
                                      training=False,
-                                     inp_batch_type=batch_type)
+                                     include_invalid=include_invalid)
     return loss_dict
 
   def infer_negatives(self, batch):
@@ -756,6 +1023,9 @@ class PRIMETransformerModel(tf.keras.Model):
     log_probs = batch['design']
     if self.contextual:
       contexts = batch['context_id']
+    # infer_negatives is only called from the graph-compiled train and eval
+    # steps, where this loop is unrolled into the step's graph, and each
+    # forward pass in it is jit compiled through call().
     for _ in range(self.num_gradient_infer_steps):
       with tf.GradientTape(
               watch_accessed_variables=False, persistent=False) as tape:
@@ -765,7 +1035,7 @@ class PRIMETransformerModel(tf.keras.Model):
         else:
           model_pred = self(log_probs, training=False)
       grad = tape.gradient(model_pred, log_probs)
-      log_probs = log_probs + self.opt_lr * grad[0]
+      log_probs = log_probs + self.opt_lr * grad
     temp_batch['design'] = tf.stop_gradient(log_probs)
     if 'context_id' in batch and self.contextual:
       temp_batch['context_id'] = batch['context_id']
@@ -786,7 +1056,8 @@ class HardwareOptProblem:
 
     config: a dictionary of various input fields and their corresponding
       possible valid number of discrete values.
-    data_file: a dictionary of a list of various input fields.
+    data_file: the records of the dataset, each a dictionary of the various
+      input fields, as a tf.data.Dataset or any iterable of dictionaries.
     params_dict: a dictionary of additional inputs to the HardwareOptProblem.
     """
 
@@ -813,6 +1084,12 @@ class HardwareOptProblem:
     self.feasible_probs,\
              self.infeasible_probs = self.dataset.get_feasible_probs(
                               add_area_constraints=self._add_area_constraints)
+    # Log probabilities for sampling the batch indices on device, infeasible
+    # (resp. feasible) points have a log probability of -inf.
+    self._log_feasible_probs = tf.math.log(
+      tf.constant(self.feasible_probs, dtype=tf.float32))
+    self._log_infeasible_probs = tf.math.log(
+      tf.constant(self.infeasible_probs, dtype=tf.float32))
 
     # Choose what kind of batch to provide while training the model
     self.get_training_batch = None
@@ -822,21 +1099,38 @@ class HardwareOptProblem:
       self.get_training_batch = self.get_mixed_batch
     else:
       self.get_training_batch = self.get_all_batch
+    # Sample the batch as one graph: the index sampling, gathers and the
+    # batch dictionary are traced once, instead of dispatched op by op on
+    # every (evaluation) call.
+    self.get_training_batch = tf.function(self.get_training_batch)
+
+  def get_training_batches(self, num_batches):
+    """
+    Get a dataset of num_batches training batches. The batches are sampled
+    in the background, and prefetched while the training step runs.
+    """
+    return tf.data.Dataset.range(num_batches).map(
+      lambda _: self.get_training_batch(),
+      num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
 
   def get_all_batch(self,):
     """Sample i.i.d. from the entire dataset."""
-    indices = np.random.randint(1,
-                                self.dataset._top, self._batch_size)
+    indices = tf.random.uniform((self._batch_size,), minval=1,
+                                maxval=self.dataset._top, dtype=tf.int32)
     batch_x, batch_y = self.dataset._get_batch(indices)
     batch_dict = dict()
     batch_dict['design'] = batch_x
     batch_dict['objective'] = batch_y
     return batch_dict
 
+  def _sample_indices(self, log_probs):
+    """Sample a batch of indices into the dataset from the log probs."""
+    return tf.random.categorical(
+      log_probs[tf.newaxis, :], self._batch_size, dtype=tf.int32)[0]
+
   def get_valid_only_batch(self,):
     """Get only valid samples in the batch."""
-    indices = np.random.choice(np.arange(0, self.dataset._top),
-                               size=self._batch_size, p=self.feasible_probs)
+    indices = self._sample_indices(self._log_feasible_probs)
     batch_x, batch_y = self.dataset._get_batch(indices)
     batch_dict = dict()
     batch_dict['design'] = batch_x
@@ -845,7 +1139,9 @@ class HardwareOptProblem:
 
   def get_top_batch(self,):
     """Get only the top scoring batch for eval"""
-    indices = self.dataset._tf_dataset['argsort'][-self.batch_size:]
+    # Only the top scores are needed, so select them rather than sorting
+    indices = tf.math.top_k(self.dataset._tf_dataset['score'],
+                            k=min(self.batch_size, self.dataset._top)).indices
     batch_x, batch_y = self.dataset._get_batch(indices)
     batch_dict = dict()
     batch_dict['design'] = batch_x
@@ -855,12 +1151,8 @@ class HardwareOptProblem:
   def get_mixed_batch(self,):
     """Get both valid and invalid samples to train in a batch"""
     # Should be called when training with invalid samples as negatives
-    valid_indices = np.random.choice(np.arange(0, self.dataset._top),
-                                     size=self._batch_size,
-                                     p=self.feasible_probs)
-    invalid_indices = np.random.choice(np.arange(0, self.dataset._top),
-                                       size=self._batch_size,
-                                       p=self.infeasible_probs)
+    valid_indices = self._sample_indices(self._log_feasible_probs)
+    invalid_indices = self._sample_indices(self._log_infeasible_probs)
     batch_x, batch_y = self.dataset._get_batch(valid_indices)
     batch_x_in, batch_y_in = self.dataset._get_batch(invalid_indices)
     batch_dict = dict()
@@ -921,71 +1213,92 @@ class PRIMEDataset(tf.Module):
 
   def get_score_function(self, ):
     """Get the objective function which is being maximized"""
-    runtime = self._tf_dataset['runtime'].numpy()
-    area = self._tf_dataset['area'].numpy()
-    scores = -runtime
-    self._tf_dataset['score'] = tf.convert_to_tensor(
-      scores, dtype=tf.float32)
+    scores = -tf.cast(self._tf_dataset['runtime'], tf.float32)
+    self._tf_dataset['score'] = tf.Variable(scores, trainable=False)
     print('Score stats: ')
     print('--------------------------------------------')
-    print('Max: ', scores.max())
-    print('Mean: ', scores.mean())
-    print('Min: ', scores.min())
+    print('Max: ', tf.reduce_max(scores).numpy())
+    print('Mean: ', tf.reduce_mean(scores).numpy())
+    print('Min: ', tf.reduce_min(scores).numpy())
     print('--------------------------------------------')
-
-    # Since we need top batch for eval, store top scores
-    self._tf_dataset['argsort'] = np.argsort(
-      self._tf_dataset['score'].numpy())
     return scores
 
   def _convert_to_tf_dataset(self, ):
       """Convert the dataset to a tensorflow dataset, easy to read from."""
-      tf_dataset = {}
-      for key in self._active_training_keys + \
-                 self._eval_metric_keys + self._validity_keys:
-          tf_dataset[key] = []
-
       # Load the data from the data file. Note that most of the fields are
       # actually not one-hots, and essentially corresponds to the original data
       # with field-value pairs for each field, and the value is a discrete value.
+      # The fields are read as whole columns: for a tf.data.Dataset by
+      # batching the entire dataset into a single element, otherwise (an
+      # iterable of records) by stacking the values of each field.
       parsed_dataset = self.data_dict
-      for p in parsed_dataset:
-          for key in p:
-              if key not in tf_dataset:
-                  continue
-              tf_dataset[key].append(p[key])
-
-      for key in self._active_training_keys + self._eval_metric_keys + self._validity_keys:
-          if key == 'infeasibility_reason':
-              continue
-          tf_dataset[key] = tf.convert_to_tensor(tf_dataset[key], tf.int32)
-
-      # Now convert the dataset to actually use one-hot representations. This is
-      # used for training, and so it is important to use this.
-      tf_actual_temp_dataset = {}
-      for key in self._active_training_keys + self._validity_keys + self._eval_metric_keys:
-          tf_actual_temp_dataset[key] = tf.cast(tf_dataset[key], dtype=tf.int32)
-
+      all_keys = self._active_training_keys + self._validity_keys + \
+                 self._eval_metric_keys
+      if isinstance(parsed_dataset, tf.data.Dataset):
+          keys = [key for key in all_keys
+                  if key in parsed_dataset.element_spec]
+          tf_dataset = parsed_dataset.map(
+              lambda p: {key: tf.cast(p[key], tf.int32) for key in keys}).batch(
+                  np.iinfo(np.int64).max).get_single_element()
+      else:
+          records = list(parsed_dataset)
+          keys = [key for key in all_keys if records and key in records[0]]
+          tf_dataset = {
+              key: tf.cast(np.asarray([p[key] for p in records]), tf.int32)
+              for key in keys}
+
+      # Map every value to its index in the value range of the field. The
+      # values are looked up in the sorted value range with a binary search,
+      # the sort order then gives the index in the original value range.
       for key in self._active_training_keys:
-          design_space_map = dict(
-              self._design_space_dict[key]['mapping_one_hot_to_value'])
-          data_val = tf_actual_temp_dataset[key].numpy().astype(np.int32).tolist()
-          out_vals = []
-          for x in data_val:
-              out_vals.append(design_space_map[x])
-
-          tf_actual_temp_dataset[key] = tf.constant(out_vals, dtype=tf.int32)
-
-      ## Finally load the tf_actual_temp_dataset into the tf_dataset
-      tf_actual_dataset = {}
-      for key in tf_actual_temp_dataset:
-          tf_actual_dataset[key] = tf_actual_temp_dataset[key]
-
-      self._tf_dataset = tf_actual_dataset
+          value_range = np.asarray(
+              self._design_space_dict[key]['value_range'], dtype=np.int32)
+          order = np.argsort(value_range)
+          values = tf_dataset[key]
+          positions = tf.minimum(
+              tf.searchsorted(value_range[order], values, out_type=tf.int32),
+              len(value_range) - 1)
+          tf.debugging.assert_equal(
+              tf.gather(value_range[order], positions), values,
+              message='Value outside the value range of ' + key)
+          tf_dataset[key] = tf.gather(
+              tf.constant(order, dtype=tf.int32), positions)
+
+      # The concatenated one-hot designs, built once so that sampling a batch
+      # is a single gather. Like the scores, these are kept in a variable, so
+      # that batch sampling functions read them in place rather than capturing
+      # the whole dataset as a constant. The one-hots are stored as uint8, a
+      # quarter of the size of float32, and cast after gathering a batch.
+      tf_dataset['design_one_hot'] = tf.Variable(tf.concat(
+          [tf.one_hot(tf_dataset[key], depth=self._segment_lengths[
+              self._design_space_dict[key]['ctr']], dtype=tf.uint8)
+           for key in self._active_training_keys], axis=1), trainable=False)
+
+      self._tf_dataset = tf_dataset
       self._infeasible_np = self._tf_dataset['infeasible'].numpy().astype(
           np.float32)
       self._top = self._infeasible_np.shape[0]
 
+  def _parse_config_lines(self, lines):
+    """Parse the field specifications, one field per line of the config."""
+    ctr = 0
+    for line in lines:
+      line = line.strip()
+      if not line:
+        continue
+      ind_field = dict()
+      split_line = line.split(':')
+      ind_field['data_type'] = split_line[0]
+      ind_field['value_range'] = [int(x) for x in split_line[-1].split(',')]
+      index_vals = np.arange(len(ind_field['value_range']))
+      ind_field['mapping_one_hot_to_value'] = dict(
+        zip(ind_field['value_range'], index_vals.tolist()))
+      ind_field['ctr'] = ctr
+      self._design_space_dict[split_line[1]] = ind_field
+      self._segment_lengths[ctr] = len(ind_field['value_range'])
+      self._max_ctr += 1
+      ctr += 1
+
   def load_or_refresh_config(self):
     """Load config file with specifications."""
     self._design_space_dict = {}
@@ -994,42 +1307,11 @@ class PRIMEDataset(tf.Module):
     try:
       # The case when the config is a file to open
       with gfile.Open(self._config, 'r') as f:
-        line = f.readline()
-        line = line.replace('\n', '')
-        # print ('Line: ', line)
-        ctr = 0
-        while line:
-          ind_field = dict()
-          split_line = line.split(':')
-          ind_field['data_type'] = split_line[0]
-          ind_field['value_range'] = [int(x) for x in split_line[-1].split(',')]
-          index_vals = np.arange(len(ind_field['value_range']))
-          ind_field['mapping_one_hot_to_value'] = zip(
-            ind_field['value_range'], index_vals)
-          ind_field['ctr'] = ctr
-          self._design_space_dict[split_line[1]] = ind_field
-          self._segment_lengths[ctr] = len(ind_field['value_range'])
-          self._max_ctr += 1
-          line = f.readline()
-          ctr += 1
+        lines = f.read().split('\n')
     except:
       # When config is a string of the contents of the file
-      lines = self._config.split("\n")
-      lines = [line.replace('\n', '') for line in lines]
-      ctr = 0
-      for line in lines:
-        ind_field = dict()
-        split_line = line.split(':')
-        ind_field['data_type'] = split_line[0]
-        ind_field['value_range'] = [int(x) for x in split_line[-1].split(',')]
-        index_vals = np.arange(len(ind_field['value_range']))
-        ind_field['mapping_one_hot_to_value'] = zip(
-          ind_field['value_range'], index_vals)
-        ind_field['ctr'] = ctr
-        self._design_space_dict[split_line[1]] = ind_field
-        self._segment_lengths[ctr] = len(ind_field['value_range'])
-        self._max_ctr += 1
-        ctr += 1
+      lines = self._config.split('\n')
+    self._parse_config_lines(lines)
 
     split_lengths = []
     for key in self._active_training_keys:
@@ -1054,57 +1336,56 @@ class PRIMEDataset(tf.Module):
       length += val
     return length
 
+  def _feasible_mask(self, add_area_constraints):
+    """Get a float mask of the points that are feasible (and within area)."""
+    feasible = 1.0 - self._infeasible_np
+    if add_area_constraints:
+      feasible_area = self._tf_dataset['area'].numpy() <= AREA_THRESHOLD
+      feasible = np.where(feasible_area, feasible, 0.0).astype(np.float32)
+      return feasible, feasible_area
+    return feasible, None
+
   def get_feasible_probs(self, add_area_constraints=False):
     """
     Get the probability of points that are feasible, meaning they don't
     violate the area constraint and also obtain the feasibility result.
     """
-    feasible = (1.0 - self._infeasible_np)
-    print('Number of feasible points: ', np.sum(feasible))
+    print('Number of feasible points: ', self._top - np.sum(self._infeasible_np))
+    feasible, feasible_area = self._feasible_mask(add_area_constraints)
+    num_feasible = np.sum(feasible)
     if add_area_constraints:
       print('Min area: ', tf.reduce_min(self._tf_dataset['area']))
-      feasible_area = (
-              self._tf_dataset['area'] <= AREA_THRESHOLD).numpy().astype(np.float32)
-      feasible = np.clip(feasible + feasible_area - 1.0,
-                         a_min=0.0, a_max=1.0)
       print('Number of feasible points due to area constraint: ',
-            np.sum(feasible_area))
+            np.count_nonzero(feasible_area))
       print('NUmber of feasible points after area constraint: ',
-            np.sum(feasible))
-    probs = feasible / np.sum(feasible)
-    infeasible_probs = (1.0 - feasible) / np.sum(1.0 - feasible)
+            num_feasible)
+    probs = feasible / num_feasible
+    infeasible_probs = (1.0 - feasible) / (self._top - num_feasible)
     return probs, infeasible_probs
 
   def valid_invalid_data_size(self, add_area_constraints=True):
     """Get the size of the valid and invalid dataset compositions."""
-    feasible = (1.0 - self._infeasible_np)
-    if add_area_constraints:
-      feasible_area = (
-              self._tf_dataset['area'] <= AREA_THRESHOLD).numpy().astype(np.float32)
-      feasible = np.clip(feasible + feasible_area - 1.0,
-                         a_min=0.0, a_max=1.0)
-    return np.sum(feasible), np.shape(feasible)[0] - np.sum(feasible)
+    num_feasible = np.sum(self._feasible_mask(add_area_constraints)[0])
+    return num_feasible, self._top - num_feasible
 
   def _get_batch(self, indices):
     """Sample a batch from the dataset."""
-    all_train_elements = []  # this is the training elements in one-hot form
-    all_test_elements = []  # this is the evaluation fields (area, runtime, score, etc)
-
-    # Discrete training input keys
-    for key in self._active_training_keys:
-      all_train_elements.append(
-        tf.one_hot(tf.gather(self._tf_dataset[key], indices),
-                   depth=self._segment_lengths[
-                     self._design_space_dict[key]['ctr']]))
-
-    # Eval keys
+    # The training elements in one-hot form, and the evaluation field (score)
+    all_train_elements = tf.cast(
+      tf.gather(self._tf_dataset['design_one_hot'], indices), tf.float32)
     all_test_elements = tf.expand_dims(
       tf.gather(self._tf_dataset['score'], indices), 1)
-    return tf.concat(all_train_elements, 1), all_test_elements
+    return all_train_elements, all_test_elements
 
 
 # @title Defining the function that runs training
 
+def _has_accelerator():
+  """Whether TensorFlow sees a GPU or a TPU."""
+  return bool(tf.config.list_logical_devices('GPU') or
+              tf.config.list_logical_devices('TPU'))
+
+
 def train_eval_offline(
         # Data flags
         config=None,
@@ -1130,7 +1411,11 @@ def train_eval_offline(
         num_votes=1,
         # PRIME parameters:
         cql_alpha=1.0,
-        infeasible_alpha=1.0):
+        infeasible_alpha=1.0,
+        # Precision of the model
+        precision_policy=None,
+        # Compilation
+        xla_autoclustering=None):
   """Training loop for the PRIME model.
 
   Most of the input arguments are primarily hyperparameters for training the
@@ -1138,120 +1423,153 @@ def train_eval_offline(
 
   save_dir: the directory where the store the saved model, and the training
     summaries. Can be a string or None.
+  precision_policy: the Keras mixed precision policy the model is built with,
+    'mixed_bfloat16' (TPU, recent GPUs), 'mixed_float16' (GPUs, with loss
+    scaling) or 'float32'. The variables, the output heads and the losses are
+    kept in float32 in every case. None picks 'mixed_bfloat16' when there is a
+    GPU or TPU and 'float32' otherwise; on CPU bfloat16 is slower (~1.85s vs
+    ~1.5s per training step). The previous global policy is restored when
+    training ends.
+  xla_autoclustering: whether to let XLA auto-cluster the ops of the training
+    and evaluation steps that are not explicitly jit compiled. None enables it
+    only when there is no GPU or TPU; on CPU it takes a training step from
+    ~2.4s to ~1.3s (20 negative inference steps, float32). The previous
+    setting is restored when training ends.
   training_dataset: a dictionary of fields in the training dataset, and their
     corresponding values used to train.
   validation_dataset: a dictionary of fields in the validation dataset, and
     their corresponding values to measure cross-validation.
   """
 
-  # First create the training dataset, note that the dataset below is a
-  # dummy dataset, that is only well-suited for training as a representative
-  # example. You can plug in the dataset from the other colab that provides
-  # the data for training, or you can add your own dataset here.
-  params_dict = dict()
-  params_dict['batch_size'] = batch_size
-  params_dict['batch_type'] = batch_type
-  params_dict['add_area_constraints'] = True
-  # Defining the problem automatically does dataset loading
-  train_problem = HardwareOptProblem(config,
-                                     training_dataset, params_dict)
-
-  # Now define the validation dataset (or val_problem)
-  val_params_dict = dict()
-  val_params_dict['batch_size'] = batch_size
-  val_params_dict['add_area_constraints'] = True
-  # Only validate on the valid samples in the validation dataset
-  val_params_dict['batch_type'] = 'valid'
-  val_problem = HardwareOptProblem(config, validation_dataset,
-                                   val_params_dict)
-
-  # The dimensionality of each parameter. this input_splits parameter goes
-  # into the PRIMETransformer, as it enables us to pass in inputd as a big
-  # vector of concatenated one-hot vectors for each discrete parameter, and
-  # then unpack it in the model training. This gives the flexibility of actually
-  # being able to use the input one-hot vectors in any way as needed.
-  input_splits = train_problem.dataset.get_input_splits()
-  print('Input splits: ', input_splits)
-
-  # Number of inputs in all: the total dimensionality of the input is given by
-  # the sum of number of possible values each discrete parameter can take
-  input_properties = train_problem.dataset.input_properties
-  print('Loaded validation dataset..', train_problem.dataset.size,
-        val_problem.dataset.size, input_properties)
-
-  feasible_size, \
-  infeasible_size = train_problem.dataset.valid_invalid_data_size()
-  print('Feasible/Infeasible size: ', feasible_size, infeasible_size)
-
-  fwd_optimizer = tf.keras.optimizers.Adam(learning_rate=opt_lr,
-                                           beta_1=opt_betas[0],
-                                           beta_2=opt_betas[1], name='opt')
-
-  training_dict = dict()
-  training_dict['training_type'] = batch_type
-  training_dict['use_dropout'] = use_dropout
-  training_dict['infeasible_alpha'] = infeasible_alpha
-  training_dict['input_splits'] = input_splits
-  training_dict['num_votes'] = num_votes
-  training_dict['infeasbile_multiplier'] = float(feasible_size) / (
-          float(infeasible_size) + 1)
-  training_dict['num_gradient_steps'] = 20
-
-  model = PRIMETransformerModel(
-    num_outputs=1,
-    num_inputs=input_properties,
-    optimizer=fwd_optimizer,
-    layers=layers,
-    penalty_weight=cql_alpha,
-    params_dict=training_dict)
-
-  rand_num = np.random.randint(10000)
-
-  # summary writer
-  if save_dir is not None:
-    save_dir = os.path.join(save_dir, str(rand_num))
-    summary_writer = tf.summary.create_file_writer(logdir=save_dir)
-    summary_writer.set_as_default()
-  else:
-    tf.summary.create_noop_writer()
-
-  print('save dir : ', save_dir)
-
-  # Now start the training
-  for step in range(train_steps):
-    batch = train_problem.get_training_batch()
-    # This is just to build the models.
-    if step == 0:
-      _ = model.measure_stats(batch)
-    loss_dict = model.perform_training(
-      batch, loss_type=loss_type,
-      ranking_penalty_weight=ranking_penalty_weight)
-
-    if step % summary_freq == 0:
-      # regular logging
-      print('-------------------------------------------------------')
-      for key in loss_dict:
-        tf.summary.scalar('train/' + key, loss_dict[key], step=step)
-        print('Step: ', step, 'train/' + key, ':', loss_dict[key])
-      print('-------------------------------------------------------')
-
-      if save_dir is not None:
-        if step == 0:
-          model.save(save_dir)
-        if step % 5000 == 0:
-          model.save_weights(os.path.join(save_dir, "ckpt-" + str(step)))
-
-    if step % eval_freq == 0:
-      val_batch = val_problem.get_training_batch()
-      # validation batches are only valid batches
-      val_loss_dict = model.measure_stats(val_batch, batch_type='valid')
-      print('-------------------------------------------------------')
-      for key in val_loss_dict:
-        tf.summary.scalar('val/' + key, val_loss_dict[key], step=step)
-        print('Step: ', step, 'val/' + key, ':', val_loss_dict[key])
-      print('-------------------------------------------------------')
-
-  print('Finished Training')
+  if precision_policy is None:
+    precision_policy = 'mixed_bfloat16' if _has_accelerator() else 'float32'
+  if xla_autoclustering is None:
+    xla_autoclustering = not _has_accelerator()
+  previous_policy = tf.keras.mixed_precision.global_policy()
+  previous_jit = tf.config.optimizer.get_jit()
+  tf.config.optimizer.set_jit('autoclustering' if xla_autoclustering else False)
+  try:
+    tf.keras.mixed_precision.set_global_policy(precision_policy)
+
+    # First create the training dataset, note that the dataset below is a
+    # dummy dataset, that is only well-suited for training as a representative
+    # example. You can plug in the dataset from the other colab that provides
+    # the data for training, or you can add your own dataset here.
+    params_dict = dict()
+    params_dict['batch_size'] = batch_size
+    params_dict['batch_type'] = batch_type
+    params_dict['add_area_constraints'] = True
+    # Defining the problem automatically does dataset loading
+    train_problem = HardwareOptProblem(config,
+                                       training_dataset, params_dict)
+
+    # Now define the validation dataset (or val_problem)
+    val_params_dict = dict()
+    val_params_dict['batch_size'] = batch_size
+    val_params_dict['add_area_constraints'] = True
+    # Only validate on the valid samples in the validation dataset
+    val_params_dict['batch_type'] = 'valid'
+    val_problem = HardwareOptProblem(config, validation_dataset,
+                                     val_params_dict)
+
+    # The dimensionality of each parameter. this input_splits parameter goes
+    # into the PRIMETransformer, as it enables us to pass in inputd as a big
+    # vector of concatenated one-hot vectors for each discrete parameter, and
+    # then unpack it in the model training. This gives the flexibility of
+    # actually being able to use the input one-hot vectors in any way as
+    # needed.
+    input_splits = train_problem.dataset.get_input_splits()
+    print('Input splits: ', input_splits)
+
+    # Number of inputs in all: the total dimensionality of the input is given by
+    # the sum of number of possible values each discrete parameter can take
+    input_properties = train_problem.dataset.input_properties
+    print('Loaded validation dataset..', train_problem.dataset.size,
+          val_problem.dataset.size, input_properties)
+
+    feasible_size, \
+    infeasible_size = train_problem.dataset.valid_invalid_data_size()
+    print('Feasible/Infeasible size: ', feasible_size, infeasible_size)
+
+    fwd_optimizer = tf.keras.optimizers.Adam(learning_rate=opt_lr,
+                                             beta_1=opt_betas[0],
+                                             beta_2=opt_betas[1], name='opt')
+    if precision_policy == 'mixed_float16':
+      # float16 gradients need loss scaling to not underflow
+      fwd_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(fwd_optimizer)
+
+    training_dict = dict()
+    training_dict['training_type'] = batch_type
+    training_dict['use_dropout'] = use_dropout
+    training_dict['infeasible_alpha'] = infeasible_alpha
+    training_dict['input_splits'] = input_splits
+    training_dict['num_votes'] = num_votes
+    training_dict['infeasbile_multiplier'] = float(feasible_size) / (
+            float(infeasible_size) + 1)
+    training_dict['num_gradient_steps'] = 20
+
+    model = PRIMETransformerModel(
+      num_outputs=1,
+      num_inputs=input_properties,
+      optimizer=fwd_optimizer,
+      layers=layers,
+      penalty_weight=cql_alpha,
+      params_dict=training_dict)
+
+    rand_num = np.random.randint(10000)
+
+    # summary writer
+    if save_dir is not None:
+      save_dir = os.path.join(save_dir, str(rand_num))
+      summary_writer = tf.summary.create_file_writer(logdir=save_dir)
+      summary_writer.set_as_default()
+    else:
+      tf.summary.create_noop_writer()
+
+    print('save dir : ', save_dir)
+
+    # This is just to build the models, with a single forward pass rather than
+    # tracing a whole evaluation step.
+    _ = model(tf.zeros([1, input_properties], dtype=tf.float32), training=False)
+
+    # Now start the training
+    train_batches = train_problem.get_training_batches(train_steps)
+    for step, batch in enumerate(train_batches):
+      loss_dict = model.perform_training(
+        batch, loss_type=loss_type,
+        ranking_penalty_weight=ranking_penalty_weight)
+
+      if step % summary_freq == 0:
+        # regular logging
+        # Copy all the losses to the host at once, rather than one per key
+        loss_values = tf.stack(list(loss_dict.values())).numpy()
+        print('-------------------------------------------------------')
+        for key, value in zip(loss_dict, loss_values):
+          tf.summary.scalar('train/' + key, value, step=step)
+          print('Step: ', step, 'train/' + key, ':', value)
+        print('-------------------------------------------------------')
+
+        if save_dir is not None:
+          if step == 0:
+            model.save(save_dir)
+          if step % 5000 == 0:
+            model.save_weights(os.path.join(save_dir, "ckpt-" + str(step)))
+
+      if step % eval_freq == 0:
+        val_batch = val_problem.get_training_batch()
+        # validation batches are only valid batches
+        val_loss_dict = model.measure_stats(val_batch, batch_type='valid')
+        val_loss_values = tf.stack(list(val_loss_dict.values())).numpy()
+        print('-------------------------------------------------------')
+        for key, value in zip(val_loss_dict, val_loss_values):
+          tf.summary.scalar('val/' + key, value, step=step)
+          print('Step: ', step, 'val/' + key, ':', value)
+        print('-------------------------------------------------------')
+
+    print('Finished Training')
+  finally:
+    tf.keras.mixed_precision.set_global_policy(previous_policy)
+    tf.config.optimizer.set_jit(previous_jit or False)
 
 
 
@@ -1259,7 +1577,8 @@ def train_eval_offline(
 import tensorflow as tf
 import numpy as np
 #@title APIs for parsing PRIME datasets
-def parse_prime_tfrecords(proto):
+def parse_prime_tfrecords(protos):
+  """Parse a batch of serialized PRIME records."""
   prime_feature_description = {
     'param_1': tf.io.FixedLenFeature([], tf.float32),
     'param_2': tf.io.FixedLenFeature([], tf.float32),
@@ -1275,15 +1594,20 @@ def parse_prime_tfrecords(proto):
     'area': tf.io.FixedLenFeature([], tf.float32),
     'infeasible':tf.io.FixedLenFeature([], tf.int64),
   }
-  return tf.io.parse_single_example(proto, prime_feature_description)
+  return tf.io.parse_example(protos, prime_feature_description)
 
 
 #@title Parsing the dataset for the studied application
 model_name = 'm4' #@param ["MobilenetEdgeTPU", "MobilenetV2", "MobilenetV3", "m4", "m5", "m6", "t_rnn_dec", "t_rnn_enc", "u-net"]
 filenames = tf.io.gfile.glob(f'gs://gresearch/prime/{model_name}/*.tfrecord')
-raw_dataset = tf.data.TFRecordDataset(filenames, num_parallel_reads=64)
-parsed_dataset = raw_dataset.map(parse_prime_tfrecords)
-filenames = tf.io.gfile.glob(f'gs://gresearch/prime/{model_name}/*.tfrecord')
+raw_dataset = tf.data.TFRecordDataset(
+    filenames, num_parallel_reads=tf.data.AUTOTUNE)
+# The records are parsed in batches, and then unbatched into single records.
+# The parsed dataset is small and read in full several times below (for the
+# temp, training and validation datasets), so cache it after the first read.
+parsed_dataset = raw_dataset.batch(1024).map(
+    parse_prime_tfrecords, num_parallel_calls=tf.data.AUTOTUNE)
+parsed_dataset = parsed_dataset.unbatch().cache()
 
 config_str = """discrete:param_1:float64:true:1,2,4,6,8,10,12,14,16,32
 discrete:param_2:float64:true:1,2,4,6,8,10,12,14,16,32